@@ -0,0 +1,85 @@
+"""
+2つのベンチマークの結果を比較する
+
+    python -m benchmarks.compare benchmarks/results/before.json benchmarks/results/after.json
+
+benchmarks.runの結果はシナリオと仮想クライアント数ごとに、benchmarks.microの結果は
+ベンチマークごとに比較する。
+"""
+
+import argparse
+import json
+import math
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+
+def change(before: float, after: float) -> str:
+    if not before or math.isnan(before) or math.isnan(after):
+        return "     n/a"
+    return f"{(after - before) / before * 100:+7.1f}%"
+
+
+def compare_load(before: List[Dict[str, Any]], after: List[Dict[str, Any]]) -> None:
+    def key(result: Dict[str, Any]) -> Tuple[str, int]:
+        return result["scenario"], result["clients"]
+
+    previous = {key(result): result for result in before}
+    print(
+        f"{'scenario':16} {'clients':>7} {'p50':>9} {'p95':>9} {'p99':>9} "
+        f"{'req/s':>9} {'rss':>9}"
+    )
+    for result in after:
+        old = previous.get(key(result))
+        if old is None:
+            print(f"{result['scenario']:16} {result['clients']:7} (new)")
+            continue
+        latency, old_latency = result["latency_ms"], old["latency_ms"]
+        print(
+            f"{result['scenario']:16} {result['clients']:7} "
+            f"{change(old_latency['p50'], latency['p50'])} "
+            f"{change(old_latency['p95'], latency['p95'])} "
+            f"{change(old_latency['p99'], latency['p99'])} "
+            f"{change(old['throughput_rps'], result['throughput_rps'])} "
+            f"{change(old['rss_mb']['max'], result['rss_mb']['max'])}"
+        )
+        if old["status"] != result["status"]:
+            print(f"  status changed: {old['status']} -> {result['status']}")
+
+
+def compare_micro(before: List[Dict[str, Any]], after: List[Dict[str, Any]]) -> None:
+    previous = {result["name"]: result for result in before}
+    print(f"{'benchmark':40} {'before':>12} {'after':>12} {'change':>9}")
+    for result in after:
+        old = previous.get(result["name"])
+        if old is None:
+            print(f"{result['name']:40} {'':>12} {result['median_us']:10.2f}us (new)")
+            continue
+        print(
+            f"{result['name']:40} {old['median_us']:10.2f}us "
+            f"{result['median_us']:10.2f}us {change(old['median_us'], result['median_us'])}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("before", type=Path)
+    parser.add_argument("after", type=Path)
+    args = parser.parse_args()
+
+    before = json.loads(args.before.read_text())
+    after = json.loads(args.after.read_text())
+    for report in (before, after):
+        dirty = " (dirty)" if report.get("dirty") else ""
+        print(
+            f"{report.get('commit', 'unknown')[:12]}{dirty} {report.get('timestamp')}"
+        )
+    print()
+    if "results" in before and "results" in after:
+        compare_load(before["results"], after["results"])
+    if "micro" in before and "micro" in after:
+        compare_micro(before["micro"], after["micro"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Rangeリクエストに対応したファイルサーバー
+
+docker-composeのfileserver(nginx)の代わりに、PMTilesとCOGをローカルで配信する。
+
+    python -m benchmarks.fileserver bench-data/files --port 8081
+"""
+
+import argparse
+import os
+import re
+import threading
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_head(self):
+        match = RANGE.match(self.headers.get("Range", "").strip())
+        if match is None:
+            return super().send_head()
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return None
+        size = os.path.getsize(path)
+        start, end = match.groups()
+        if start == "":
+            # bytes=-N は末尾のNバイト
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end) if end else size - 1, size - 1)
+        if size <= start or end < start:
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return None
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self._remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile) -> None:
+        remaining = getattr(self, "_remaining", None)
+        if remaining is None:
+            super().copyfile(source, outputfile)
+            return
+        while remaining > 0:
+            chunk = source.read(min(64 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+        self._remaining = None
+
+
+class FileServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 既定の5では同時接続が多いと接続の確立が待たされる
+    request_queue_size = 128
+
+
+def serve(directory: Path, port: int) -> ThreadingHTTPServer:
+    """
+    別スレッドでファイルサーバーを起動する
+    """
+
+    def handler(*args, **kwargs):
+        return RangeRequestHandler(*args, directory=str(directory), **kwargs)
+
+    server = FileServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    server = serve(args.directory, args.port)
+    print(f"serving {args.directory} on http://127.0.0.1:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+共通モジュールの処理ごとのマイクロベンチマーク
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro --filter encoding --output micro.json
+
+サーバーやデータベースを起動せずに、タイルのリクエストごとに実行される処理
+(範囲の判定、圧縮、キャッシュ、メトリクスの記録)の1回あたりの時間を計測する。
+"""
+
+import argparse
+import gzip
+import json
+import random
+import sys
+import time
+import timeit
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+from .fixtures import BOUNDS, ROOT, tiles_in_bounds, vector_tile
+from .run import git_revision
+
+sys.path[:0] = [str(ROOT / "common"), str(ROOT / "poi-server")]
+
+from app.tile_cache import TileCache, affected_tiles  # noqa: E402
+from tilecommon import (  # noqa: E402
+    BoundsCoverage,
+    Metrics,
+    QuadtreeCoverage,
+    SingleFlight,
+    TileSetCoverage,
+    compress_variants,
+    select_variant,
+    tile_key,
+    transcode,
+)
+from tilecommon.coverage import lonlat_to_mercator  # noqa: E402
+
+Benchmark = Tuple[str, Callable[[], Any]]
+
+ACCEPT_ENCODING = "gzip, deflate, br"
+
+
+def coverage_benchmarks(rng: random.Random) -> List[Benchmark]:
+    tiles = list(tiles_in_bounds(0, 14))
+    queries = [rng.choice(tiles) for _ in range(1000)]
+    queries += [(z, x + 2**z // 2, y) for z, x, y in queries]
+    west, south, east, north = BOUNDS
+    bboxes = []
+    for _ in range(50_000):
+        x, y = lonlat_to_mercator(rng.uniform(west, east), rng.uniform(south, north))
+        bboxes.append((x, y, x, y))
+
+    tileset = TileSetCoverage(tiles)
+    bounds = BoundsCoverage(BOUNDS, 0, 14)
+    quadtree = QuadtreeCoverage(bboxes)
+
+    def covers(coverage: Any) -> Callable[[], Any]:
+        return lambda: [coverage.covers(*tile) for tile in queries]
+
+    return [
+        ("coverage.tileset.covers[2000]", covers(tileset)),
+        ("coverage.bounds.covers[2000]", covers(bounds)),
+        ("coverage.quadtree.covers[2000]", covers(quadtree)),
+        ("coverage.quadtree.build[50000]", lambda: QuadtreeCoverage(bboxes)),
+    ]
+
+
+def encoding_benchmarks(rng: random.Random) -> List[Benchmark]:
+    small = vector_tile(rng, 14)
+    large = vector_tile(rng, 8)
+    stored = gzip.compress(large)
+    variants = compress_variants(small)
+    return [
+        (
+            f"encoding.compress_variants[{len(small)}B]",
+            lambda: compress_variants(small),
+        ),
+        (
+            f"encoding.compress_variants[{len(large)}B]",
+            lambda: compress_variants(large),
+        ),
+        (
+            "encoding.select_variant",
+            lambda: select_variant(variants, ACCEPT_ENCODING),
+        ),
+        (
+            "encoding.transcode.passthrough",
+            lambda: transcode(stored, "gzip", ACCEPT_ENCODING),
+        ),
+        (
+            "encoding.transcode.identity",
+            lambda: transcode(stored, "gzip", "identity"),
+        ),
+    ]
+
+
+def singleflight_benchmarks(rng: random.Random) -> List[Benchmark]:
+    flight = SingleFlight()
+    return [
+        ("singleflight.tile_key", lambda: tile_key("vector", 14, 14552, 6451)),
+        (
+            "singleflight.do",
+            lambda: flight.do(tile_key("vector", 14, 14552, 6451), len, b""),
+        ),
+    ]
+
+
+def tile_cache_benchmarks(rng: random.Random) -> List[Benchmark]:
+    tiles = list(tiles_in_bounds(10, 14))
+    variants = compress_variants(vector_tile(rng, 14))
+    # 4096件のタイルを保持できる大きさにして、以降の格納で古いタイルを追い出す
+    size = sum(len(data) for data in variants.values())
+    cache = TileCache(max_bytes=4096 * size)
+    for tile in tiles[:4096]:
+        cache.put(tile, 0, variants)
+    hot = tiles[:4096]
+    cold = tiles[4096:]
+    west, south, east, north = BOUNDS
+    points = [(rng.uniform(west, east), rng.uniform(south, north)) for _ in range(2)]
+
+    def put() -> None:
+        tile = rng.choice(cold)
+        with cache.rendering(tile) as version:
+            cache.put(tile, version, variants)
+
+    return [
+        ("tile_cache.get.hit", lambda: cache.get(rng.choice(hot))),
+        ("tile_cache.put.evict", put),
+        ("tile_cache.affected_tiles[2]", lambda: affected_tiles(points)),
+        (
+            "tile_cache.invalidate",
+            lambda: cache.invalidate(affected_tiles(points)),
+        ),
+    ]
+
+
+def metrics_benchmarks(rng: random.Random) -> List[Benchmark]:
+    metrics = Metrics()
+    for route in ("/vector/{z}/{x}/{y}.pbf", "/raster/{z}/{x}/{y}.png"):
+        for _ in range(1000):
+            metrics.record_request("GET", route, 200, 1000, 0.0, rng.random())
+
+    def phase() -> None:
+        with metrics.phase("db"):
+            pass
+
+    return [
+        (
+            "metrics.record_request",
+            lambda: metrics.record_request(
+                "GET", "/vector/{z}/{x}/{y}.pbf", 200, 1000, 0.0, 0.01
+            ),
+        ),
+        ("metrics.phase", phase),
+        ("metrics.render", metrics.render),
+    ]
+
+
+GROUPS = [
+    coverage_benchmarks,
+    encoding_benchmarks,
+    singleflight_benchmarks,
+    tile_cache_benchmarks,
+    metrics_benchmarks,
+]
+
+
+def measure(fn: Callable[[], Any], repeat: int, budget: float) -> Dict[str, float]:
+    """
+    `budget`秒程度で終わる回数を1組として`repeat`組実行し、1回あたりの時間を返す
+    """
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * budget / max(elapsed, 1e-9)))
+    runs = sorted(t / number for t in timer.repeat(repeat=repeat, number=number))
+    return {
+        "number": number,
+        "min_us": runs[0] * 1e6,
+        "median_us": runs[len(runs) // 2] * 1e6,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--filter", help="名前にこの文字列を含むベンチマークのみ実行")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    results = []
+    for group in GROUPS:
+        for name, fn in group(random.Random(args.seed)):
+            if args.filter and args.filter not in name:
+                continue
+            result = {"name": name, **measure(fn, args.repeat, args.budget)}
+            print(
+                f"{name:40} {result['median_us']:12.2f}us "
+                f"(min {result['min_us']:.2f}us)"
+            )
+            results.append(result)
+
+    report = {
+        **git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {"repeat": args.repeat, "budget": args.budget, "seed": args.seed},
+        "micro": results,
+    }
+    output = args.output or (
+        ROOT
+        / "benchmarks"
+        / "results"
+        / f"micro-{report['commit'][:12] or 'unknown'}-{time.strftime('%Y%m%d%H%M%S')}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,502 @@
+"""
+各サーバーにタイルのリクエストを再生して性能を計測する
+
+    python -m benchmarks.fixtures --out bench-data --dsn postgresql://.../bench
+    python -m benchmarks.run --data bench-data --dsn postgresql://.../bench
+    python -m benchmarks.run --data bench-data --scenarios mbtile-vector,cog-rgbnir
+
+シナリオと同時実行数ごとにサーバーを起動し直し、キャッシュが空の状態から計測する。
+結果(レイテンシーのp50/p95/p99、スループット、サーバーのRSS)はJSONに出力し、
+`python -m benchmarks.compare`でコミット間の結果を比較できる。
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from .fixtures import ROOT
+from .traces import Tile, pan_zoom_trace
+
+
+@dataclass
+class Step:
+    """
+    書き込みのシナリオで、最初のリクエストに続けて送るリクエスト
+
+    パスとボディの{id}は、直前のレスポンス(GeoJSONのFeature)のidで置き換える。
+    """
+
+    method: str
+    path: str
+    body: Optional[str] = None
+
+
+@dataclass
+class Scenario:
+    name: str
+    # サーバーのディレクトリとASGIアプリケーション
+    server: str
+    app: str
+    # {z}、{x}、{y}、中心の{lon}、{lat}、範囲の{west}、{south}、{east}、{north}で
+    # 置き換えるパス
+    path: str
+    minzoom: int
+    maxzoom: int
+    start_zoom: int
+    # 必要なデータ(mbtiles: 作業ディレクトリのMBTiles、files: ファイルサーバー、
+    # local: 作業ディレクトリから../dataで参照するファイル、postgis)
+    source: str
+    # Trueの場合はタイルごとではなく画面ごとに、画面の範囲で1回リクエストする
+    per_screen: bool = False
+    method: str = "GET"
+    # パスと同じ値で置き換えるJSONのボディ
+    body: Optional[str] = None
+    steps: Tuple[Step, ...] = ()
+
+
+SCENARIOS = [
+    Scenario(
+        "mbtile-vector", "mbtile-server", "main:app",
+        "/vector/{z}/{x}/{y}.pbf", 8, 14, 10, "mbtiles",
+    ),
+    Scenario(
+        "mbtile-raster", "mbtile-server", "main:app",
+        "/raster/{z}/{x}/{y}.png", 6, 12, 9, "mbtiles",
+    ),
+    Scenario(
+        "pmtile-vector", "pmtile-server", "main:app",
+        "/vector/{z}/{x}/{y}.pbf", 8, 14, 10, "files",
+    ),
+    Scenario(
+        "pmtile-raster", "pmtile-server", "main:app",
+        "/raster/{z}/{x}/{y}.png", 6, 12, 9, "files",
+    ),
+    Scenario(
+        "cog-rgbnir", "cog-server", "main:app",
+        "/tiles_async/{z}/{x}/{y}.png", 10, 15, 12, "files",
+    ),
+    Scenario(
+        "dynamic-school", "dynamic-tile-server", "main:app",
+        "/vector/{z}/{x}/{y}.pbf", 6, 16, 10, "postgis",
+    ),
+    Scenario(
+        "dynamic-admin", "dynamic-tile-server", "main:app",
+        "/admin/{z}/{x}/{y}.pbf", 6, 16, 10, "postgis",
+    ),
+    Scenario(
+        "poi-tiles", "poi-server", "app.main:app",
+        "/pois/tiles/{z}/{x}/{y}.pbf", 4, 16, 9, "postgis",
+    ),
+    Scenario(
+        "poi-nearest", "poi-server", "app.main:app",
+        "/pois/nearest?lon={lon}&lat={lat}&k=10", 10, 16, 12, "postgis",
+    ),
+    Scenario(
+        "poi-all", "poi-server", "app.main:app",
+        "/pois", 10, 16, 12, "postgis", per_screen=True,
+    ),
+    Scenario(
+        "poi-bbox", "poi-server", "app.main:app",
+        "/pois_sql2?bbox={west},{south},{east},{north}", 10, 16, 12, "postgis",
+        per_screen=True,
+    ),
+    # 画面ごとにPOIを作成し、画面の角に移動してから削除する(タイルの無効化を含む)
+    Scenario(
+        "poi-write", "poi-server", "app.main:app",
+        "/pois", 10, 16, 12, "postgis", per_screen=True,
+        method="POST",
+        body='{{"name": "bench", "longitude": {lon}, "latitude": {lat}}}',
+        steps=(
+            Step("PATCH", "/pois/{id}", '{{"longitude": {west}, "latitude": {north}}}'),
+            Step("DELETE", "/pois/{id}"),
+        ),
+    ),
+    Scenario(
+        "satellite-points", "poi-satellite-app/api", "app.main:app",
+        "/points", 10, 16, 12, "postgis", per_screen=True,
+    ),
+    Scenario(
+        "dynamic-image-rescale", "dynamic-image-tile-server", "main:app",
+        "/rgbnir_cog_dynamic_rescale.png?scale_min=0&scale_max=3000", 10, 16, 12,
+        "local", per_screen=True,
+    ),
+]  # fmt: skip
+
+
+def tile_lonlat(z: int, x: float, y: float) -> Tuple[float, float]:
+    n = 2**z
+    lon = x / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lon, lat
+
+
+def path_params(tiles: List[Tile]) -> Dict[str, Any]:
+    """
+    パスに埋め込む、タイル(の集まり)の位置と範囲
+    """
+    z, x, y = tiles[0]
+    min_x = min(t[1] for t in tiles)
+    max_x = max(t[1] for t in tiles) + 1
+    min_y = min(t[2] for t in tiles)
+    max_y = max(t[2] for t in tiles) + 1
+    west, north = tile_lonlat(z, min_x, min_y)
+    east, south = tile_lonlat(z, max_x, max_y)
+    lon, lat = tile_lonlat(z, (min_x + max_x) / 2, (min_y + max_y) / 2)
+    values = {
+        "lon": lon,
+        "lat": lat,
+        "west": west,
+        "south": south,
+        "east": east,
+        "north": north,
+    }
+    return {
+        "z": z,
+        "x": x,
+        "y": y,
+        **{name: round(value, 6) for name, value in values.items()},
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        return None
+    return None
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return math.nan
+    index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def prepare_workdir(data: Path, scenario: Scenario) -> Path:
+    """
+    サーバーの作業ディレクトリ
+
+    サーバーはstaticディレクトリとMBTilesを作業ディレクトリから読み込むため、
+    合成データのディレクトリにstaticへのリンクを作成して起動する。
+    作業ディレクトリから../dataでファイルを読み込むサーバーのために、
+    合成データのfilesディレクトリへのリンクも作成する。
+    """
+    workdir = data / ("mbtile" if scenario.source == "mbtiles" else scenario.server)
+    workdir.mkdir(parents=True, exist_ok=True)
+    static = workdir / "static"
+    if not static.exists() and (ROOT / scenario.server / "static").exists():
+        static.symlink_to(ROOT / scenario.server / "static")
+    files = workdir.parent / "data"
+    if scenario.source == "local" and not files.exists():
+        files.symlink_to((data / "files").resolve())
+    return workdir
+
+
+class Process:
+    """
+    ベンチマーク中に起動しておくサーバーのプロセス
+
+    負荷をかけるクライアントとGILを共有しないように、別プロセスで起動する。
+    """
+
+    def __init__(self, args: List[str], cwd: Path, env: Dict[str, str], ready: str):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.ready = ready
+        pythonpath = [str(ROOT / "common"), os.environ.get("PYTHONPATH", "")]
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", *args, "--port", str(self.port)],
+            cwd=cwd,
+            env={
+                **os.environ,
+                **env,
+                "PYTHONPATH": os.pathsep.join(p for p in pythonpath if p),
+            },
+            stdout=subprocess.DEVNULL,
+        )
+
+    async def wait_ready(self, timeout: float = 60.0) -> None:
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            while time.monotonic() < deadline:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"server exited with {self.process.returncode}")
+                try:
+                    response = await client.get(self.url + self.ready)
+                    if response.status_code == 200:
+                        return
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise TimeoutError("server did not become ready")
+
+    def stop(self) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def start_server(scenario: Scenario, workdir: Path, env: Dict[str, str]) -> Process:
+    args = ["uvicorn", scenario.app, "--app-dir", str(ROOT / scenario.server)]
+    return Process(args + ["--log-level", "warning"], workdir, env, "/health")
+
+
+def start_fileserver(directory: Path) -> Process:
+    args = ["benchmarks.fileserver", str(directory.resolve())]
+    return Process(args, ROOT, {}, "/")
+
+
+async def replay(
+    url: str,
+    scenario: Scenario,
+    clients: int,
+    parallel: int,
+    steps: int,
+    seed: int,
+    pid: int,
+) -> Dict[str, Any]:
+    """
+    `clients`個の仮想クライアントがそれぞれの操作の列を再生する
+
+    クライアントは画面ごとに最大`parallel`個のタイルを同時にリクエストし、
+    画面のタイルがすべて揃ってから次の操作に進む。
+    """
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    errors = 0
+    received = 0
+    rss: List[int] = []
+    headers = {"accept-encoding": "gzip, deflate, br"}
+    json_headers = {"content-type": "application/json"}
+    limits = httpx.Limits(max_connections=clients * parallel)
+
+    async def send(
+        client: httpx.AsyncClient, method: str, path: str, body: Optional[str]
+    ) -> Optional[bytes]:
+        nonlocal errors, received
+        chunks = []
+        started = time.perf_counter()
+        try:
+            async with client.stream(
+                method,
+                url + path,
+                headers=headers if body is None else {**headers, **json_headers},
+                content=body,
+            ) as response:
+                async for chunk in response.aiter_raw():
+                    received += len(chunk)
+                    chunks.append(chunk)
+        except httpx.HTTPError:
+            errors += 1
+            return None
+        latencies.append(time.perf_counter() - started)
+        key = str(response.status_code)
+        statuses[key] = statuses.get(key, 0) + 1
+        return b"".join(chunks) if response.is_success else None
+
+    async def fetch(client: httpx.AsyncClient, tiles: List[Tile]) -> None:
+        params = path_params(tiles)
+        body = scenario.body.format(**params) if scenario.body else None
+        content = await send(
+            client, scenario.method, scenario.path.format(**params), body
+        )
+        for step in scenario.steps:
+            # 直前のリクエストが失敗した場合は、対象がないため以降のリクエストを送らない
+            if content is None:
+                return
+            params["id"] = json.loads(content)["properties"]["id"]
+            body = step.body.format(**params) if step.body else None
+            content = await send(client, step.method, step.path.format(**params), body)
+
+    async def run_client(client: httpx.AsyncClient, index: int) -> None:
+        screens = pan_zoom_trace(
+            seed + index,
+            steps,
+            scenario.minzoom,
+            scenario.maxzoom,
+            scenario.start_zoom,
+        )
+        semaphore = asyncio.Semaphore(parallel)
+
+        async def limited(tiles: List[Tile]) -> None:
+            async with semaphore:
+                await fetch(client, tiles)
+
+        for screen in screens:
+            if scenario.per_screen:
+                await fetch(client, screen)
+            else:
+                await asyncio.gather(*(limited([tile]) for tile in screen))
+
+    async def sample_rss(stop: asyncio.Event) -> None:
+        while not stop.is_set():
+            value = rss_bytes(pid)
+            if value is not None:
+                rss.append(value)
+            await asyncio.sleep(0.1)
+
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(stop))
+    started = time.perf_counter()
+    async with httpx.AsyncClient(limits=limits, timeout=60.0) as client:
+        await asyncio.gather(*(run_client(client, i) for i in range(clients)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await sampler
+
+    latencies.sort()
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "status": statuses,
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else math.nan,
+        "bytes": received,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "mean": sum(latencies) / len(latencies) * 1000 if latencies else math.nan,
+            "max": latencies[-1] * 1000 if latencies else math.nan,
+        },
+        "rss_mb": {
+            "max": max(rss) / 2**20 if rss else math.nan,
+            "end": rss[-1] / 2**20 if rss else math.nan,
+        },
+    }
+
+
+def git_revision() -> Dict[str, Any]:
+    def git(*args: str) -> str:
+        return subprocess.run(
+            ["git", *args], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain")),
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    names = set(args.scenarios.split(",")) if args.scenarios else None
+    scenarios = [s for s in SCENARIOS if names is None or s.name in names]
+    fileserver = None
+    env: Dict[str, str] = {}
+    if any(s.source == "files" for s in scenarios):
+        fileserver = start_fileserver(args.data / "files")
+        await fileserver.wait_ready()
+        env["FILESERVER_URL"] = fileserver.url
+    if args.dsn:
+        env["DATABASE_URL"] = args.dsn
+
+    results = []
+    try:
+        for scenario in scenarios:
+            if scenario.source == "postgis" and not args.dsn:
+                print(f"skip {scenario.name}: --dsn is not specified")
+                continue
+            workdir = prepare_workdir(args.data, scenario)
+            for clients in args.concurrency:
+                server = start_server(scenario, workdir, env)
+                try:
+                    await server.wait_ready()
+                    result = await replay(
+                        server.url,
+                        scenario,
+                        clients,
+                        args.parallel,
+                        args.steps,
+                        args.seed,
+                        server.process.pid,
+                    )
+                finally:
+                    server.stop()
+                result = {"scenario": scenario.name, "clients": clients, **result}
+                latency = result["latency_ms"]
+                print(
+                    f"{scenario.name:16} clients={clients:<4} "
+                    f"p50={latency['p50']:8.2f}ms p95={latency['p95']:8.2f}ms "
+                    f"p99={latency['p99']:8.2f}ms {result['throughput_rps']:8.1f} req/s "
+                    f"rss={result['rss_mb']['max']:7.1f}MB errors={result['errors']}"
+                )
+                results.append(result)
+    finally:
+        if fileserver is not None:
+            fileserver.stop()
+
+    return {
+        **git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "config": {
+            "concurrency": args.concurrency,
+            "parallel": args.parallel,
+            "steps": args.steps,
+            "seed": args.seed,
+            "scenarios": [asdict(s) for s in scenarios],
+        },
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--data", type=Path, default=ROOT / "bench-data")
+    parser.add_argument("--dsn", help="benchmarks.fixturesで地物を登録したデータベース")
+    parser.add_argument("--scenarios", help="カンマ区切りのシナリオ名(省略時はすべて)")
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(v) for v in value.split(",")],
+        default=[1, 8, 32],
+        help="カンマ区切りの仮想クライアント数",
+    )
+    parser.add_argument("--parallel", type=int, default=6)
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    output = args.output or (
+        ROOT
+        / "benchmarks"
+        / "results"
+        / f"{report['commit'][:12] or 'unknown'}-{time.strftime('%Y%m%d%H%M%S')}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
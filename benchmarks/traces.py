@@ -0,0 +1,63 @@
+"""
+地図の操作(パンとズーム)を模したタイルのリクエストの列を作成する
+"""
+
+import random
+from typing import List, Tuple
+
+from .fixtures import CENTER, lonlat_to_tile
+
+Tile = Tuple[int, int, int]
+
+# 1画面に表示するタイルの数(横、縦)
+VIEWPORT = (5, 4)
+
+
+def viewport(z: int, cx: int, cy: int) -> List[Tile]:
+    """
+    画面に表示するタイルを、地図ライブラリと同様に中心に近い順に並べる
+    """
+    width, height = VIEWPORT
+    n = 2**z
+    tiles = [
+        (z, (cx + dx) % n, cy + dy)
+        for dx in range(-(width // 2), width - width // 2)
+        for dy in range(-(height // 2), height - height // 2)
+        if 0 <= cy + dy < n
+    ]
+    return sorted(tiles, key=lambda t: abs(t[1] - cx) + abs(t[2] - cy))
+
+
+def pan_zoom_trace(
+    seed: int,
+    steps: int,
+    minzoom: int,
+    maxzoom: int,
+    start_zoom: int,
+    center: Tuple[float, float] = CENTER,
+) -> List[List[Tile]]:
+    """
+    画面ごとのタイルの一覧
+
+    7割はパン(1から2タイル分の移動)、残りはズームインかズームアウトで、
+    同じシードからは常に同じ操作の列を作成する。
+    """
+    rng = random.Random(seed)
+    z = start_zoom
+    cx, cy = lonlat_to_tile(center[0], center[1], z)
+    screens = [viewport(z, cx, cy)]
+    for _ in range(steps):
+        action = rng.random()
+        if action < 0.7:
+            cx += rng.choice((-2, -1, 0, 1, 2))
+            cy += rng.choice((-2, -1, 0, 1, 2))
+        elif action < 0.85 and z < maxzoom:
+            z += 1
+            cx, cy = cx * 2 + rng.randint(0, 1), cy * 2 + rng.randint(0, 1)
+        elif minzoom < z:
+            z -= 1
+            cx, cy = cx // 2, cy // 2
+        n = 2**z
+        cx, cy = cx % n, min(max(cy, 0), n - 1)
+        screens.append(viewport(z, cx, cy))
+    return screens
@@ -1,17 +1,40 @@
-import asyncio
-from typing import Optional, Tuple
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
 
 from fastapi import FastAPI, Response
 from fastapi.staticfiles import StaticFiles
+from rio_tiler.errors import TileOutsideBounds
 from rio_tiler.io import Reader
 from rio_tiler.profiles import img_profiles
+from tilecommon import BoundsCoverage, Metrics, SingleFlight, tile_key
 
 app = FastAPI()
+metrics = Metrics()
+metrics.install(app)
+
+# COGを配信するファイルサーバー(ベンチマークなどでは環境変数で変更する)
+FILESERVER_URL = os.environ.get("FILESERVER_URL", "http://fileserver")
+RGBNIR_COG_URL = f"{FILESERVER_URL}/rgbnir_cog.tif"
+B02_COG_URL = "https://sentinel-cogs.s3.us-west-2.amazonaws.com/sentinel-s2-l2a-cogs/54/T/WN/2023/11/S2B_54TWN_20231118_1_L2A/B02.tif"
+
+# 同じタイルへの同時リクエストを1回のCOGの読み込みにまとめる
+flight = SingleFlight()
+metrics.register_singleflight("tiles", flight)
+
+# COGからタイルを作成するエグゼキューター
+executor = ThreadPoolExecutor()
+metrics.register_executor("tiles", executor)
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "singleflight": flight.stats()}
 
 
 @app.get("/rgbnir_remote_cog.png")
 async def make_image_remote_cog(scale_min: float, scale_max: float):
-    with Reader("http://fileserver/rgbnir_cog.tif") as image:
+    with Reader(RGBNIR_COG_URL) as image:
         image_data = image.preview([1, 2, 3])
         image_data.rescale(((scale_min, scale_max),))
     png = image_data.render(img_format="PNG", **img_profiles.get("png"))
@@ -28,7 +51,7 @@ async def make_image_remote_cog_part(
     scale_min: float = 0.0,
     scale_max: float = 2000.0,
 ):
-    with Reader("http://fileserver/rgbnir_cog.tif") as image:
+    with Reader(RGBNIR_COG_URL) as image:
         image_data = image.part(
             bbox=(minx, miny, maxx, maxy),
             indexes=(1, 2, 3),
@@ -48,7 +71,7 @@ async def make_image_remote_cog_tile(
     scale_min: float = 0.0,
     scale_max: float = 2000.0,
 ):
-    with Reader("http://fileserver/rgbnir_cog.tif") as image:
+    with Reader(RGBNIR_COG_URL) as image:
         image_data = image.tile(
             x, y, z, indexes=(1, 2, 3), resampling_method="bilinear"
         )
@@ -57,6 +80,33 @@ async def make_image_remote_cog_tile(
     return Response(png, media_type="image/png")
 
 
+# ネイティブ解像度より大きいズームレベルのタイルは拡大して配信する
+MAX_ZOOM = 24
+
+
+# 読み込み済みのCOGの範囲(URLごと)
+coverages: Dict[str, BoundsCoverage] = {}
+# 範囲の読み込みはタイルの描画として集計しないため、タイルとは別にまとめる
+coverage_flight = SingleFlight()
+
+
+def read_coverage(url: str) -> BoundsCoverage:
+    with Reader(url) as image:
+        coverage = BoundsCoverage(image.geographic_bounds, image.minzoom, MAX_ZOOM)
+    coverages[url] = coverage
+    return coverage
+
+
+async def get_coverage(url: str) -> BoundsCoverage:
+    # 最初のリクエストでCOGの範囲と最小ズームレベルを読み込み、
+    # 以降は範囲外のタイルにCOGを開かずにイベントループ上で応答する
+    coverage = coverages.get(url)
+    if coverage is not None:
+        return coverage
+    # 読み込みはエグゼキューターで実行し、同時に届いたリクエストでは1回にまとめる
+    return await coverage_flight.do_async(url, read_coverage, url, executor=executor)
+
+
 def get_tile(
     url: str,
     z: int,
@@ -65,13 +115,19 @@ def get_tile(
     indexes: Optional[Tuple[int, ...]],
     scale_min: float,
     scale_max: float,
-):
-    with Reader(url) as image:
-        if not image.tile_exists(x, y, z):
+) -> Optional[bytes]:
+    with Reader(url) as image, metrics.phase("read"):
+        try:
+            image_data = image.tile(
+                x, y, z, indexes=indexes, resampling_method="bilinear"
+            )
+        except TileOutsideBounds:
+            # 範囲の判定は外接矩形で行うため、境界付近ではCOGと重ならないタイルがある
             return None
-        image_data = image.tile(x, y, z, indexes=indexes, resampling_method="bilinear")
+    with metrics.phase("rescale"):
         image_data.rescale(((scale_min, scale_max),))
-    png = image_data.render(img_format="PNG", **img_profiles.get("png"))
+    with metrics.phase("encode"):
+        png = image_data.render(img_format="PNG", **img_profiles.get("png"))
     return png
 
 
@@ -79,20 +135,25 @@ def get_tile(
 async def make_image_remote_cog_tile_async(
     z: int, x: int, y: int, scale_min: float = 0.0, scale_max: float = 2000.0
 ):
-    if z < 6:
+    coverage = await get_coverage(RGBNIR_COG_URL)
+    if not coverage.zoom_in_range(z):
         return Response(status_code=404)
-    loop = asyncio.get_event_loop()
-    png = await loop.run_in_executor(
-        None,
+    if not coverage.covers(z, x, y):
+        return Response(status_code=204)
+    png = await flight.do_async(
+        tile_key("rgbnir", z, x, y, scale_min=scale_min, scale_max=scale_max),
         get_tile,
-        "http://fileserver/rgbnir_cog.tif",
+        RGBNIR_COG_URL,
         z,
         x,
         y,
         (1, 2, 3),
         scale_min,
         scale_max,
+        executor=executor,
     )
+    if png is None:
+        return Response(status_code=204)
     return Response(png, media_type="image/png")
 
 
@@ -100,20 +161,25 @@ async def make_image_remote_cog_tile_async(
 async def make_image_remote_b2_tile_async(
     z: int, x: int, y: int, scale_min: float = 0.0, scale_max: float = 2000.0
 ):
-    if z < 6:
+    coverage = await get_coverage(B02_COG_URL)
+    if not coverage.zoom_in_range(z):
         return Response(status_code=404)
-    loop = asyncio.get_event_loop()
-    png = await loop.run_in_executor(
-        None,
+    if not coverage.covers(z, x, y):
+        return Response(status_code=204)
+    png = await flight.do_async(
+        tile_key("b02", z, x, y, scale_min=scale_min, scale_max=scale_max),
         get_tile,
-        "https://sentinel-cogs.s3.us-west-2.amazonaws.com/sentinel-s2-l2a-cogs/54/T/WN/2023/11/S2B_54TWN_20231118_1_L2A/B02.tif",
+        B02_COG_URL,
         z,
         x,
         y,
         None,
         scale_min,
         scale_max,
+        executor=executor,
     )
+    if png is None:
+        return Response(status_code=204)
     return Response(png, media_type="image/png")
 
 
@@ -0,0 +1,34 @@
+from .cache import VariantCache
+from .coverage import (
+    BoundsCoverage,
+    QuadtreeCoverage,
+    RefreshingCoverage,
+    TileSetCoverage,
+)
+from .encoding import (
+    accepts,
+    compress_variants,
+    detect_encoding,
+    encoding_headers,
+    select_variant,
+    transcode,
+)
+from .metrics import Metrics
+from .singleflight import SingleFlight, tile_key
+
+__all__ = [
+    "BoundsCoverage",
+    "Metrics",
+    "QuadtreeCoverage",
+    "RefreshingCoverage",
+    "SingleFlight",
+    "TileSetCoverage",
+    "VariantCache",
+    "accepts",
+    "compress_variants",
+    "detect_encoding",
+    "encoding_headers",
+    "select_variant",
+    "tile_key",
+    "transcode",
+]
@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+# エンコーディングごとのタイルの内容(Noneは圧縮なし)
+Variants = Dict[Optional[str], bytes]
+
+
+class VariantCache:
+    """
+    圧縮済みのタイルを保持する、合計のバイト数と有効期限で制限したLRUキャッシュ
+
+    1件あたりのサイズはタイルによって大きく異なるため、件数ではなくすべての
+    エンコーディングの合計のバイト数で制限する。`max_bytes`より大きいタイルは保持しない。
+    タイルの内容と合わせて、呼び出し元が内容を識別するためのバージョンを保持できる。
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # キーごとの(有効期限, バイト数, バージョン, 内容)
+        self._entries: "OrderedDict[Hashable, Tuple[float, int, int, Variants]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _, _ = self._entries.pop(key)
+        self.size -= size
+
+    def get(self, key: Hashable) -> Optional[Variants]:
+        entry = self.get_versioned(key)
+        return None if entry is None else entry[1]
+
+    def get_versioned(self, key: Hashable) -> Optional[Tuple[int, Variants]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, _, version, variants = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return version, variants
+
+    def put(self, key: Hashable, variants: Variants, version: int = 0) -> None:
+        size = sum(len(data) for data in variants.values())
+        if self.max_bytes < size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, version, variants)
+            self.size += size
+            while self.max_bytes < self.size:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
@@ -0,0 +1,206 @@
+import abc
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+
+logger = logging.getLogger("tilecommon")
+
+# Webメルカトル(EPSG:3857)の原点から端までの距離
+ORIGIN = 20037508.342789244
+
+BBox = Tuple[float, float, float, float]
+
+
+def lonlat_to_mercator(longitude: float, latitude: float) -> Tuple[float, float]:
+    latitude = max(-85.0511287798066, min(85.0511287798066, latitude))
+    x = math.radians(longitude) * 6378137.0
+    y = math.log(math.tan(math.pi / 4 + math.radians(latitude) / 2)) * 6378137.0
+    return x, y
+
+
+def tile_range(bbox: BBox, z: int) -> Tuple[int, int, int, int]:
+    """
+    EPSG:3857の範囲(minx, miny, maxx, maxy)と交差するタイルのx, yの範囲
+    """
+    n = 2**z
+    size = 2 * ORIGIN / n
+    minx, miny, maxx, maxy = bbox
+    min_x = int((minx + ORIGIN) // size)
+    max_x = int((maxx + ORIGIN) // size)
+    min_y = int((ORIGIN - maxy) // size)
+    max_y = int((ORIGIN - miny) // size)
+    return (
+        min(max(min_x, 0), n - 1),
+        min(max(min_y, 0), n - 1),
+        min(max(max_x, 0), n - 1),
+        min(max(max_y, 0), n - 1),
+    )
+
+
+class Coverage(abc.ABC):
+    """
+    データソースがタイルを持つ範囲
+
+    `covers`がFalseのタイルはストレージにアクセスせずに空のタイルとして応答できる。
+    """
+
+    def __init__(self, minzoom: int, maxzoom: int):
+        self.minzoom = minzoom
+        self.maxzoom = maxzoom
+
+    def zoom_in_range(self, z: int) -> bool:
+        return self.minzoom <= z <= self.maxzoom
+
+    @abc.abstractmethod
+    def covers(self, z: int, x: int, y: int) -> bool: ...
+
+
+class TileSetCoverage(Coverage):
+    """
+    タイルの一覧(MBTilesなど)から作成する、タイルの有無を正確に判定するカバレッジ
+    """
+
+    def __init__(self, tiles: Iterable[Tuple[int, int, int]]):
+        self._tiles: Dict[int, Set[int]] = defaultdict(set)
+        for z, x, y in tiles:
+            self._tiles[z].add((x << z) | y)
+        if self._tiles:
+            super().__init__(min(self._tiles), max(self._tiles))
+        else:
+            super().__init__(0, -1)
+
+    def covers(self, z: int, x: int, y: int) -> bool:
+        tiles = self._tiles.get(z)
+        return tiles is not None and ((x << z) | y) in tiles
+
+
+class BoundsCoverage(Coverage):
+    """
+    データの範囲(EPSG:4326)と交差するタイルを持つとみなすカバレッジ
+    """
+
+    def __init__(self, bounds: BBox, minzoom: int, maxzoom: int):
+        super().__init__(minzoom, maxzoom)
+        west, south, east, north = bounds
+        self.bbox = lonlat_to_mercator(west, south) + lonlat_to_mercator(east, north)
+
+    def covers(self, z: int, x: int, y: int) -> bool:
+        if not self.zoom_in_range(z):
+            return False
+        min_x, min_y, max_x, max_y = tile_range(self.bbox, z)
+        return min_x <= x <= max_x and min_y <= y <= max_y
+
+
+class QuadtreeCoverage(Coverage):
+    """
+    地物の範囲(EPSG:3857)から作成する、地物が存在するタイルの四分木
+
+    地物の範囲は、`index_zoom`以下で交差するタイルが`max_tiles`以下となる
+    最も大きいズームレベルのタイルとして登録する。大きな地物でも登録するタイルの数が
+    増えすぎないため、地物の数に比例したメモリで作成できる。
+    """
+
+    def __init__(
+        self,
+        bboxes: Iterable[BBox],
+        index_zoom: int = 10,
+        minzoom: int = 0,
+        maxzoom: int = 22,
+        max_tiles: int = 16,
+    ):
+        super().__init__(minzoom, maxzoom)
+        self.index_zoom = index_zoom
+        # 地物の範囲として登録したタイル(子孫のタイルはすべて地物を持つ可能性がある)
+        self._leaves: Dict[int, Set[int]] = defaultdict(set)
+        # 登録したタイルの祖先のタイル
+        self._nodes: Dict[int, Set[int]] = defaultdict(set)
+        for bbox in bboxes:
+            for z in range(index_zoom, -1, -1):
+                min_x, min_y, max_x, max_y = tile_range(bbox, z)
+                if (max_x - min_x + 1) * (max_y - min_y + 1) <= max_tiles:
+                    break
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    self._leaves[z].add((x << z) | y)
+                    for parent in range(z - 1, -1, -1):
+                        shift = z - parent
+                        self._nodes[parent].add(((x >> shift) << parent) | (y >> shift))
+
+    def covers(self, z: int, x: int, y: int) -> bool:
+        if not self.zoom_in_range(z):
+            return False
+        if z <= self.index_zoom and ((x << z) | y) in self._nodes.get(z, ()):
+            return True
+        for parent in range(min(z, self.index_zoom), -1, -1):
+            shift = z - parent
+            key = ((x >> shift) << parent) | (y >> shift)
+            if key in self._leaves.get(parent, ()):
+                return True
+        return False
+
+
+class RefreshingCoverage:
+    """
+    一定時間ごとに作り直すカバレッジ
+
+    データベースのように起動後に更新されるデータソースに使用する。作成は別スレッドで
+    行い、作成を終えてから`ttl`秒を過ぎたカバレッジは使用しない。`get`がNoneを
+    返す場合(作成中、作成の失敗、期限切れ)は、呼び出し元はストレージにアクセスする。
+    作成には時間がかかるため、期限の前に作り直しを始められるように、作成を終えてから
+    `interval`秒(省略時は`ttl`の半分)を過ぎると作り直しを始める。
+    """
+
+    def __init__(
+        self,
+        build: Callable[[], Coverage],
+        ttl: float,
+        interval: Optional[float] = None,
+        retry: float = 10.0,
+    ):
+        self._build = build
+        self.ttl = ttl
+        self.interval = ttl / 2 if interval is None else interval
+        self.retry = retry
+        self._coverage: Optional[Coverage] = None
+        self._expires = 0.0
+        self._refresh_at = 0.0
+        self._building = False
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[Coverage]:
+        now = time.monotonic()
+        with self._lock:
+            if self._refresh_at <= now and not self._building:
+                self._building = True
+                threading.Thread(target=self._refresh, daemon=True).start()
+            if now < self._expires:
+                return self._coverage
+            return None
+
+    def _refresh(self) -> None:
+        started = time.monotonic()
+        try:
+            coverage = self._build()
+        except Exception:
+            logger.exception("failed to build coverage")
+            with self._lock:
+                self._refresh_at = time.monotonic() + self.retry
+                self._building = False
+            return
+        finished = time.monotonic()
+        # 期限は作成を終えた時点から計算するため、データソースの更新が反映されるまでの
+        # 時間は最大で作成にかかった時間と`ttl`の合計になる
+        if self.ttl < finished - started:
+            logger.warning(
+                "building coverage took %.1fs, longer than its ttl %.1fs",
+                finished - started,
+                self.ttl,
+            )
+        with self._lock:
+            self._building = False
+            self._coverage = coverage
+            self._expires = finished + self.ttl
+            self._refresh_at = finished + self.interval
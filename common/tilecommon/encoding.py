@@ -0,0 +1,138 @@
+import gzip
+from typing import Dict, Optional, Sequence, Tuple
+
+try:
+    import brotli
+except ImportError:  # brotliがインストールされていない場合はgzipのみを使用
+    brotli = None
+
+# 優先順に並べた、サーバーで圧縮できるエンコーディング
+COMPRESSIONS: Tuple[str, ...] = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def accepted_encodings(accept_encoding: Optional[str]) -> Dict[str, float]:
+    """
+    Accept-Encodingヘッダーをエンコーディングと品質値の辞書に変換
+    """
+    accepted: Dict[str, float] = {}
+    if not accept_encoding:
+        return accepted
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def accepts(accept_encoding: Optional[str], encoding: Optional[str]) -> bool:
+    if encoding is None:
+        return True
+    accepted = accepted_encodings(accept_encoding)
+    return accepted.get(encoding, accepted.get("*", 0.0)) > 0.0
+
+
+def negotiate(
+    accept_encoding: Optional[str], available: Sequence[str] = COMPRESSIONS
+) -> Optional[str]:
+    """
+    クライアントが受け付けるエンコーディングのうち、品質値が最も高いものを返す
+
+    受け付けるエンコーディングがない場合は、圧縮しないことを表すNoneを返す。
+    """
+    accepted = accepted_encodings(accept_encoding)
+    best, best_q = None, 0.0
+    for encoding in available:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if best_q < q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(data: bytes, encoding: Optional[str]) -> bytes:
+    if encoding is None:
+        return data
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(data, quality=5)
+    raise ValueError(f"{encoding}で圧縮できません。")
+
+
+def decompress(data: bytes, encoding: Optional[str]) -> bytes:
+    if encoding is None:
+        return data
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "br" and brotli is not None:
+        return brotli.decompress(data)
+    raise ValueError(f"{encoding}を展開できません。")
+
+
+def can_decompress(encoding: Optional[str]) -> bool:
+    return (
+        encoding is None
+        or encoding == "gzip"
+        or (encoding == "br" and brotli is not None)
+    )
+
+
+def detect_encoding(data: bytes) -> Optional[str]:
+    """
+    圧縮形式を宣言していないアーカイブ(MBTilesなど)のタイルの圧縮形式を先頭のバイト列から判定
+    """
+    if data[:2] == b"\x1f\x8b":
+        return "gzip"
+    if data[:4] == b"\x28\xb5\x2f\xfd":
+        return "zstd"
+    return None
+
+
+def compress_variants(data: bytes) -> Dict[Optional[str], bytes]:
+    """
+    タイルをサーバーで対応するすべてのエンコーディングで圧縮
+    """
+    variants: Dict[Optional[str], bytes] = {None: data}
+    # 空のタイルは圧縮するとかえって大きくなる
+    if data:
+        for encoding in COMPRESSIONS:
+            variants[encoding] = compress(data, encoding)
+    return variants
+
+
+def select_variant(
+    variants: Dict[Optional[str], bytes], accept_encoding: Optional[str]
+) -> Tuple[bytes, Optional[str]]:
+    encoding = negotiate(accept_encoding, [e for e in variants if e is not None])
+    return variants[encoding], encoding
+
+
+def transcode(
+    data: bytes, stored: Optional[str], accept_encoding: Optional[str]
+) -> Tuple[bytes, Optional[str]]:
+    """
+    アーカイブに格納されたタイルをクライアントが受け付けるエンコーディングに変換
+
+    格納されたエンコーディングをクライアントが受け付ける場合は、そのまま返す。
+    """
+    if accepts(accept_encoding, stored) or not can_decompress(stored):
+        return data, stored
+    raw = decompress(data, stored)
+    encoding = negotiate(accept_encoding)
+    return compress(raw, encoding), encoding
+
+
+def encoding_headers(encoding: Optional[str]) -> Dict[str, str]:
+    headers = {"vary": "accept-encoding"}
+    if encoding is not None:
+        headers["content-encoding"] = encoding
+    return headers
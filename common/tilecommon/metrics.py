@@ -0,0 +1,404 @@
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter as Tally
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi import FastAPI, Response
+
+logger = logging.getLogger("tilecommon")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# 処理中のリクエストのために各スレッドが処理した期間(スレッド, 開始, 終了)
+Spans = List[Tuple[int, float, float]]
+_request_spans: ContextVar[Optional[Spans]] = ContextVar("request_spans", default=None)
+# 処理中のリクエストのASGIのscope(ルーティング後はマッチしたルートを参照できる)
+_request_scope: ContextVar[Optional[Dict[str, Any]]] = ContextVar(
+    "request_scope", default=None
+)
+
+
+def _labels(**labels: Any) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in items
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _labels(**labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # ラベルごとのバケットの件数(累積ではない)、合計、件数
+        self._values: Dict[Labels, Tuple[List[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _labels(**labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    le = _format_labels(labels, (("le", str(bound)),))
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                le = _format_labels(labels, (("le", "+Inf"),))
+                lines.append(f"{self.name}_bucket{le} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """
+    出力するたびに登録された関数を呼び出して値を取得するメトリクス
+    """
+
+    def __init__(self, name: str, help: str, type: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.collectors: List[Callable[[], Dict[Labels, float]]] = []
+
+    def render(self) -> List[str]:
+        values: Dict[Labels, float] = {}
+        for collect in self.collectors:
+            values.update(collect())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+def _route(scope: Optional[Dict[str, Any]]) -> str:
+    # ルーティング後のscopeにはマッチしたルートが設定される
+    if scope is None:
+        return "other"
+    return getattr(scope.get("route"), "path", "other")
+
+
+class SlowRequestProfiler:
+    """
+    遅いリクエストの処理中にどこで時間を使っていたかを記録するサンプリングプロファイラー
+
+    別スレッドで一定間隔ですべてのスレッドのスタックを記録する。しきい値より遅い
+    リクエストが完了すると、そのリクエストを処理したスレッドの処理中の期間
+    (`Metrics.phase`で計測した期間)に記録されたスタックを集計してログに出力する。
+    集計と出力はイベントループをブロックしないように別スレッドで行う。
+    """
+
+    # 待機中のスレッドとみなすモジュール
+    IDLE_MODULES = ("threading.py", "selectors.py", "queue.py", "thread.py")
+
+    def __init__(self, threshold: float, interval: float = 0.01, top: int = 10):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self._samples: deque = deque(maxlen=100_000)
+        self._reports: "queue.Queue[Tuple[str, float, float, Spans]]" = queue.Queue(
+            maxsize=100
+        )
+        # サンプリングで除外するため、集計するスレッドを先に開始する
+        self._reporter = threading.Thread(target=self._report, daemon=True)
+        self._reporter.start()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def _sample(self) -> None:
+        ignored = {threading.get_ident(), self._reporter.ident}
+        while True:
+            now = time.perf_counter()
+            for ident, frame in sys._current_frames().items():
+                if ident in ignored:
+                    continue
+                if frame.f_code.co_filename.endswith(self.IDLE_MODULES):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                self._samples.append((now, ident, ";".join(reversed(stack))))
+            time.sleep(self.interval)
+
+    def report(self, route: str, started: float, finished: float, spans: Spans) -> None:
+        if finished - started < self.threshold:
+            return
+        try:
+            self._reports.put_nowait((route, started, finished, spans))
+        except queue.Full:
+            # 集計が追いつかない場合は、リクエストを遅らせずに破棄する
+            pass
+
+    def _report(self) -> None:
+        while True:
+            route, started, finished, spans = self._reports.get()
+            stacks = Tally(
+                stack
+                for at, ident, stack in list(self._samples)
+                if started <= at <= finished
+                and any(
+                    ident == thread and begin <= at <= end
+                    for thread, begin, end in spans
+                )
+            )
+            lines = [f"slow request: {route} {finished - started:.3f}s"]
+            for stack, count in stacks.most_common(self.top):
+                lines.append(f"{count * self.interval:.3f}s {stack}")
+            logger.warning("\n".join(lines))
+
+
+class MetricsMiddleware:
+    """
+    ルートごとの処理時間とレスポンスのバイト数を記録するASGIミドルウェア
+    """
+
+    def __init__(self, app: Any, metrics: "Metrics"):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+        sent = 0
+        spans: Spans = []
+        token = _request_spans.set(spans)
+        scope_token = _request_scope.set(scope)
+
+        async def counting_send(message: Dict[str, Any]) -> None:
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, counting_send)
+        finally:
+            _request_spans.reset(token)
+            _request_scope.reset(scope_token)
+            finished = time.perf_counter()
+            route = _route(scope)
+            self.metrics.record_request(
+                scope["method"], route, status, sent, started, finished, spans
+            )
+
+
+class Metrics:
+    """
+    サービスのメトリクスをPrometheusのテキスト形式で公開する
+
+    `install`でミドルウェアと`/metrics`を登録する。StaticFilesを"/"にマウントする
+    前に呼び出すこと。環境変数`SLOW_REQUEST_MS`を指定すると、その時間より遅い
+    リクエストのスタックをログに出力する。
+    """
+
+    def __init__(self) -> None:
+        self._metrics: List[Any] = []
+        self.request_seconds = self.histogram(
+            "http_request_duration_seconds",
+            "Request latency by route.",
+            LATENCY_BUCKETS,
+        )
+        self.requests = self.counter(
+            "http_requests_total", "Requests by route and status."
+        )
+        self.response_bytes = self.counter(
+            "http_response_bytes_total", "Response body bytes sent by route."
+        )
+        self.phase_seconds = self.histogram(
+            "tile_phase_duration_seconds",
+            "Time spent in each phase (db, search, read, rescale, encode) by route.",
+            LATENCY_BUCKETS,
+        )
+        self.cache_requests = self.counter(
+            "cache_requests_total", "Cache lookups by cache and result."
+        )
+        slow_request_ms = float(os.environ.get("SLOW_REQUEST_MS", "0"))
+        self.profiler: Optional[SlowRequestProfiler] = None
+        if 0 < slow_request_ms:
+            self.profiler = SlowRequestProfiler(slow_request_ms / 1000)
+
+    def counter(self, name: str, help: str) -> Counter:
+        metric = Counter(name, help)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float]) -> Histogram:
+        metric = Histogram(name, help, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], Dict[Labels, float]],
+        type: str = "gauge",
+    ) -> Gauge:
+        # 同じ名前のメトリクスは1つにまとめて出力する
+        for metric in self._metrics:
+            if metric.name == name:
+                break
+        else:
+            metric = Gauge(name, help, type)
+            self._metrics.append(metric)
+        metric.collectors.append(collect)
+        return metric
+
+    def install(self, app: FastAPI) -> None:
+        app.add_middleware(MetricsMiddleware, metrics=self)
+        app.add_api_route("/metrics", self.endpoint, include_in_schema=False)
+
+    def endpoint(self) -> Response:
+        return Response(content=self.render(), media_type="text/plain; version=0.0.4")
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def record_request(
+        self,
+        method: str,
+        route: str,
+        status: int,
+        sent: int,
+        started: float,
+        finished: float,
+        spans: Optional[Spans] = None,
+    ) -> None:
+        self.request_seconds.observe(finished - started, method=method, route=route)
+        self.requests.inc(method=method, route=route, status=status)
+        self.response_bytes.inc(sent, route=route)
+        if self.profiler is not None:
+            self.profiler.report(f"{method} {route}", started, finished, spans or [])
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            finished = time.perf_counter()
+            self.phase_seconds.observe(
+                finished - started, phase=name, route=_route(_request_scope.get())
+            )
+            # プロファイラーが集計するリクエストを処理したスレッドと期間を記録
+            spans = _request_spans.get()
+            if spans is not None and self.profiler is not None:
+                spans.append((threading.get_ident(), started, finished))
+
+    def cache(self, name: str, hit: bool) -> None:
+        self.cache_requests.inc(cache=name, result="hit" if hit else "miss")
+
+    def register_pool(self, name: str, pool: Any) -> None:
+        """
+        psycopg2のコネクションプールの使用状況を公開
+        """
+
+        def collect() -> Dict[Labels, float]:
+            # psycopg2のプールは使用状況を公開していないため内部の属性を参照する
+            return {
+                _labels(pool=name, state="used"): len(pool._used),
+                _labels(pool=name, state="idle"): len(pool._pool),
+                _labels(pool=name, state="max"): pool.maxconn,
+            }
+
+        self.gauge("db_pool_connections", "Database pool connections.", collect)
+
+    def register_executor(self, name: str, executor: Any) -> None:
+        """
+        ThreadPoolExecutorの処理待ちのタスクの数を公開
+        """
+
+        def collect() -> Dict[Labels, float]:
+            return {_labels(executor=name): executor._work_queue.qsize()}
+
+        self.gauge("executor_queue_depth", "Tasks waiting for a worker.", collect)
+
+    def register_singleflight(self, name: str, flight: Any) -> None:
+        def renders() -> Dict[Labels, float]:
+            return {_labels(flight=name): flight.stats()["renders"]}
+
+        def saved() -> Dict[Labels, float]:
+            return {_labels(flight=name): flight.stats()["saved"]}
+
+        self.gauge(
+            "singleflight_renders_total", "Renders executed.", renders, "counter"
+        )
+        self.gauge(
+            "singleflight_saved_total",
+            "Renders saved by joining an in-flight render.",
+            saved,
+            "counter",
+        )
+
+    def register_cache(self, name: str, cache: Any) -> None:
+        """
+        VariantCacheなど`len`と`size`を持つキャッシュの件数とバイト数を公開
+        """
+
+        def entries() -> Dict[Labels, float]:
+            return {_labels(cache=name): len(cache)}
+
+        def size() -> Dict[Labels, float]:
+            return {_labels(cache=name): cache.size}
+
+        self.gauge("cache_entries", "Entries held by the cache.", entries)
+        self.gauge("cache_bytes", "Bytes held by the cache.", size)
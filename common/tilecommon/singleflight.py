@@ -0,0 +1,118 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+def tile_key(route: str, z: int, x: int, y: int, **params: Any) -> Tuple[Any, ...]:
+    """
+    タイルのリクエストを正規化したキー
+
+    パラメーターの指定順序や`1`と`1.0`のような表記の違いで別のキーにならないようにする。
+    """
+    normalized = tuple(
+        sorted(
+            (name, float(value) if isinstance(value, int) else value)
+            for name, value in params.items()
+        )
+    )
+    return (route, z, x, y, normalized)
+
+
+class SingleFlight:
+    """
+    同じキーの同時リクエストを1回の処理にまとめる
+
+    最初のリクエストだけが処理を実行し、処理中に届いた同じキーのリクエストはその結果を待つ。
+    同期ハンドラーからは`do`、非同期ハンドラーからは`do_async`を使用し、
+    両者が同じキーで処理を共有できる。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._inflight: Dict[Hashable, Future] = {}
+        # 実際に処理を実行した回数
+        self.renders = 0
+        # 他のリクエストの処理結果を共有したことで省略できた回数
+        self.saved = 0
+
+    def _join(self, key: Hashable) -> Tuple[Future, bool]:
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.saved += 1
+                return future, False
+            future = Future()
+            self._inflight[key] = future
+            self.renders += 1
+            return future, True
+
+    def _finish(
+        self,
+        key: Hashable,
+        future: Future,
+        result: Any = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        # 処理後のリクエストは新たに処理させるため、結果を設定する前に登録を解除する
+        with self._lock:
+            del self._inflight[key]
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def do(self, key: Hashable, fn: Callable[..., T], *args: Any) -> T:
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def do_async(
+        self,
+        key: Hashable,
+        fn: Callable[..., T],
+        *args: Any,
+        executor: Optional[Executor] = None,
+    ) -> T:
+        """
+        `fn`をエグゼキューターで実行し、イベントループをブロックせずに結果を待つ
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.shield(asyncio.wrap_future(future))
+        loop = asyncio.get_running_loop()
+        # run_in_executorはコンテキストを引き継がないため、メトリクスがリクエストを
+        # 識別できるように呼び出し元のコンテキストで実行する
+        context = contextvars.copy_context()
+        inner = loop.run_in_executor(executor, context.run, fn, *args)
+
+        def done(f: "asyncio.Future[T]") -> None:
+            # イベントループの終了などで取り消された場合も登録を解除し、
+            # 待っているリクエストには取り消しを伝える
+            if f.cancelled():
+                self._finish(key, future, error=asyncio.CancelledError())
+                return
+            error = f.exception()
+            self._finish(key, future, None if error else f.result(), error)
+
+        inner.add_done_callback(done)
+        # 最初のリクエストが切断されても、待っている他のリクエストには結果を返す
+        return await asyncio.shield(inner)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "renders": self.renders,
+                "saved": self.saved,
+                "inflight": len(self._inflight),
+            }
@@ -1,8 +1,33 @@
-from fastapi import FastAPI, Response
+import sqlite3
+from contextlib import closing
+from typing import Optional
+
+from fastapi import FastAPI, Header, Response
 from fastapi.staticfiles import StaticFiles
 from pymbtiles import MBtiles
+from tilecommon import (
+    Metrics,
+    TileSetCoverage,
+    detect_encoding,
+    encoding_headers,
+    transcode,
+)
 
 app = FastAPI()
+metrics = Metrics()
+metrics.install(app)
+
+
+def build_coverage(path: str) -> TileSetCoverage:
+    # MBTilesに格納されているタイルの一覧を起動時に読み込む
+    with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+        rows = conn.execute("SELECT zoom_level, tile_column, tile_row FROM tiles")
+        # tms -> xyz
+        return TileSetCoverage((z, x, 2**z - y - 1) for z, x, y in rows)
+
+
+vector_coverage = build_coverage("vector.mbtiles")
+raster_coverage = build_coverage("raster.mbtiles")
 
 
 @app.get("/health")
@@ -11,24 +36,37 @@ def health():
 
 
 @app.get("/vector/{z}/{x}/{y}.pbf")
-def vectortile(z: int, x: int, y:int):
+def vectortile(z: int, x: int, y: int, accept_encoding: Optional[str] = Header(None)):
+    if not vector_coverage.zoom_in_range(z):
+        return Response(status_code=404)
+    if not vector_coverage.covers(z, x, y):
+        return Response(status_code=204)
     # xyz -> tms
     y = 2**z - y - 1
-    with MBtiles("vector.mbtiles") as src:
+    with MBtiles("vector.mbtiles") as src, metrics.phase("read"):
         tile_data = src.read_tile(z=z, x=x, y=y)
     if tile_data is None:
         return Response(status_code=404)
+    # MBTilesは圧縮形式を宣言しないため、格納されたタイルから判定する
+    with metrics.phase("encode"):
+        content, encoding = transcode(
+            tile_data, detect_encoding(tile_data), accept_encoding
+        )
     return Response(
-        content=tile_data,
+        content=content,
         media_type="application/vnd.mapbox-vector-tile",
-        headers={"content-encoding": "gzip"}
+        headers=encoding_headers(encoding),
     )
 
 
 @app.get("/raster/{z}/{x}/{y}.png")
 def rastertile(z: int, x: int, y: int):
+    if not raster_coverage.zoom_in_range(z):
+        return Response(status_code=404)
+    if not raster_coverage.covers(z, x, y):
+        return Response(status_code=204)
     y = 2**z - y - 1
-    with MBtiles("raster.mbtiles") as src:
+    with MBtiles("raster.mbtiles") as src, metrics.phase("read"):
         tile_data = src.read_tile(z=z, x=x, y=y)
     if tile_data is None:
         return Response(status_code=404)
@@ -1,9 +1,27 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
 from aiopmtiles import Reader
-from fastapi import FastAPI, Response
+from fastapi import FastAPI, Header, Response
 from fastapi.staticfiles import StaticFiles
+from tilecommon import Metrics, accepts, encoding_headers, transcode
 
 app = FastAPI()
 
+# PMTilesを配信するファイルサーバー(ベンチマークなどでは環境変数で変更する)
+FILESERVER_URL = os.environ.get("FILESERVER_URL", "http://fileserver")
+metrics = Metrics()
+metrics.install(app)
+
+# タイルの展開と再圧縮を実行するエグゼキューター
+executor = ThreadPoolExecutor()
+metrics.register_executor("transcode", executor)
+
+# PMTilesのヘッダーで宣言された圧縮形式とContent-Encodingの対応
+COMPRESSIONS = {"NONE": None, "GZIP": "gzip", "BROTLI": "br", "ZSTD": "zstd"}
+
 
 @app.get("/health")
 def health():
@@ -11,22 +29,36 @@ def health():
 
 
 @app.get("/vector/{z}/{x}/{y}.pbf")
-async def vectortile(z: int, x: int, y: int):
-    async with Reader("http://fileserver/vector.pmtiles") as pmtiles:
-        tile_data = await pmtiles.get_tile(z, x, y)
+async def vectortile(
+    z: int, x: int, y: int, accept_encoding: Optional[str] = Header(None)
+):
+    async with Reader(f"{FILESERVER_URL}/vector.pmtiles") as pmtiles:
+        with metrics.phase("read"):
+            tile_data = await pmtiles.get_tile(z, x, y)
+        stored = COMPRESSIONS.get(pmtiles.tile_compression.name)
     if tile_data is None:
         return Response(status_code=404)
+    if accepts(accept_encoding, stored):
+        content, encoding = tile_data, stored
+    else:
+        # 展開と再圧縮はイベントループをブロックしないようにエグゼキューターで実行
+        loop = asyncio.get_running_loop()
+        with metrics.phase("encode"):
+            content, encoding = await loop.run_in_executor(
+                executor, transcode, tile_data, stored, accept_encoding
+            )
     return Response(
-        content=tile_data,
+        content=content,
         media_type="application/vnd.mapbox-vector-tile",
-        headers={"content-encoding": "gzip"},
+        headers=encoding_headers(encoding),
     )
 
 
 @app.get("/raster/{z}/{x}/{y}.png")
 async def rastertile(z: int, x: int, y: int):
-    async with Reader("http://fileserver/raster.pmtiles") as pmtiles:
-        tile_data = await pmtiles.get_tile(z, x, y)
+    async with Reader(f"{FILESERVER_URL}/raster.pmtiles") as pmtiles:
+        with metrics.phase("read"):
+            tile_data = await pmtiles.get_tile(z, x, y)
     if tile_data is None:
         return Response(status_code=404)
     return Response(content=tile_data, media_type="image/png")
@@ -0,0 +1,117 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+
+from tilecommon import VariantCache
+from tilecommon.cache import Variants
+from tilecommon.coverage import lonlat_to_mercator, tile_range
+
+Tile = Tuple[int, int, int]
+
+# 配信するズームレベルの範囲
+MIN_ZOOM = 0
+MAX_ZOOM = 22
+
+
+def affected_tiles(points: Iterable[Tuple[float, float]]) -> Set[Tile]:
+    """
+    点(経度, 緯度)を含むタイルを、配信するすべてのズームレベルについて返す
+    """
+    tiles = set()
+    for longitude, latitude in points:
+        mx, my = lonlat_to_mercator(longitude, latitude)
+        for z in range(MIN_ZOOM, MAX_ZOOM + 1):
+            x, y, _, _ = tile_range((mx, my, mx, my), z)
+            tiles.add((z, x, y))
+    return tiles
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    If-None-Matchヘッダーのいずれかのエンティティタグと一致するか
+
+    If-None-Matchは弱い比較で判定するため、CDNなどが付けた`W/`は無視する。
+    """
+    if if_none_match is None:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+class TileCache:
+    """
+    バージョンを付けてタイルを保持する、合計のバイト数で制限したLRUキャッシュ
+
+    タイルは圧縮済みの内容と合わせて保持する。
+    バージョンはキャッシュ全体で単調増加するカウンターの、描画を開始した時点の値で、
+    POIが編集されると、影響を受けるタイルをキャッシュから削除してカウンターを進める。
+    ETagにバージョンを含めることで、ブラウザやCDNのキャッシュも再検証で更新される。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 6 * 60 * 60):
+        self._tiles = VariantCache(max_bytes, ttl)
+        # プロセスの再起動でバージョンが重複しないように起動時刻をETagに含める
+        self.epoch = format(time.time_ns(), "x")
+        self._clock = 0
+        # 描画中に無効化されたときのカウンターの値
+        # 無効化の前に開始した描画の内容を破棄するためだけに使うため、描画中のタイルのみ保持する
+        self._invalidated: Dict[Tile, int] = {}
+        # タイルごとの描画中の処理の数
+        self._rendering: Dict[Tile, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return self._tiles.size
+
+    def __len__(self) -> int:
+        return len(self._tiles)
+
+    def etag(self, tile: Tile, version: int, encoding: Optional[str] = None) -> str:
+        z, x, y = tile
+        return f'"{self.epoch}-{z}-{x}-{y}-{version}-{encoding or "identity"}"'
+
+    @contextmanager
+    def rendering(self, tile: Tile) -> Iterator[int]:
+        """
+        描画中のタイルを登録し、キャッシュに格納するときのバージョンを返す
+
+        `put`はこのコンテキストの中で呼び出すこと。
+        """
+        with self._lock:
+            version = self._clock
+            self._rendering[tile] = self._rendering.get(tile, 0) + 1
+        try:
+            yield version
+        finally:
+            with self._lock:
+                self._rendering[tile] -= 1
+                if self._rendering[tile] == 0:
+                    del self._rendering[tile]
+                    self._invalidated.pop(tile, None)
+
+    def get(self, tile: Tile) -> Optional[Tuple[int, Variants]]:
+        return self._tiles.get_versioned(tile)
+
+    def put(self, tile: Tile, version: int, data: Variants) -> None:
+        with self._lock:
+            # 描画中にタイルが無効化された場合は古い内容をキャッシュしない
+            if version < self._invalidated.get(tile, 0):
+                return
+            self._tiles.put(tile, data, version)
+
+    def invalidate(self, tiles: Iterable[Tile]) -> None:
+        with self._lock:
+            self._clock += 1
+            for tile in tiles:
+                self._tiles.discard(tile)
+                if tile in self._rendering:
+                    self._invalidated[tile] = self._clock
@@ -0,0 +1,205 @@
+-- 低ズームレベルのタイルで配信するPOIのクラスタ
+--
+-- ズームレベルごとに、タイルを縦横poi_cluster_grid()個に分割したセルに含まれる
+-- POIを1つの地物に集約する。1タイルに含まれる地物はセルの数以下になるため、
+-- POIの件数に関わらずタイルのサイズが一定以下に収まる。
+-- poiテーブルが更新されると、トリガーで影響を受けるセルの件数と座標の合計を差分で更新する。
+
+-- クラスタを作成する最大ズームレベル(このズームレベル未満でクラスタを配信)
+-- app/main.pyはこの値を読み込んで、クラスタを配信するズームレベルを判定する
+CREATE OR REPLACE FUNCTION poi_cluster_max_zoom() RETURNS INTEGER AS $$
+    SELECT 10
+$$ LANGUAGE sql IMMUTABLE;
+
+-- タイルを分割するセルの数
+-- IMMUTABLEのため、app/main.pyのクエリでは定数に展開されてインデックスを使用できる
+CREATE OR REPLACE FUNCTION poi_cluster_grid() RETURNS INTEGER AS $$
+    SELECT 32
+$$ LANGUAGE sql IMMUTABLE;
+
+-- 集計済みのクラスタを作り直すため、既存のテーブルは削除する
+DROP TABLE IF EXISTS poi_cluster;
+CREATE TABLE poi_cluster (
+    zoom INTEGER NOT NULL,
+    cell_x INTEGER NOT NULL,
+    cell_y INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    -- POIの座標(EPSG:3857)の合計(POIの追加と削除で差分のみを更新する)
+    sum_x DOUBLE PRECISION NOT NULL,
+    sum_y DOUBLE PRECISION NOT NULL,
+    -- クラスタを代表するPOI(IDが最小のPOI)
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    geom GEOMETRY (POINT, 3857) GENERATED ALWAYS AS (
+        ST_SetSRID(ST_MakePoint(sum_x / count, sum_y / count), 3857)
+    ) STORED,
+    PRIMARY KEY (zoom, cell_x, cell_y)
+);
+
+-- POIの名前の変更時に代表するクラスタを検索
+CREATE INDEX poi_cluster_id_idx ON poi_cluster (id);
+
+-- 以前の定義(セルごとに再集計するplpgsqlの関数)を置き換える
+DROP FUNCTION IF EXISTS refresh_poi_cluster_cell(INTEGER, INTEGER, INTEGER);
+DROP FUNCTION IF EXISTS poi_cluster_cell(GEOMETRY, INTEGER);
+DROP FUNCTION IF EXISTS poi_cluster_cell_envelope(INTEGER, INTEGER, INTEGER);
+
+-- 点が含まれるセルの位置(タイル座標と同様に左上が原点)
+-- 問い合わせにインライン展開されるようにSQL関数で定義する
+CREATE OR REPLACE FUNCTION poi_cluster_cell(geom GEOMETRY, zoom INTEGER)
+RETURNS TABLE (cell_x INTEGER, cell_y INTEGER) AS $$
+    SELECT
+        floor(
+            (ST_X(p) + 20037508.342789244)
+            / (2 * 20037508.342789244 / ((2 ^ zoom) * poi_cluster_grid()))
+        )::INTEGER,
+        floor(
+            (20037508.342789244 - ST_Y(p))
+            / (2 * 20037508.342789244 / ((2 ^ zoom) * poi_cluster_grid()))
+        )::INTEGER
+    FROM
+        ST_Transform(geom, 3857) p
+$$ LANGUAGE sql IMMUTABLE;
+
+-- セルの範囲(EPSG:4326)
+CREATE OR REPLACE FUNCTION poi_cluster_cell_envelope(
+    zoom INTEGER, cell_x INTEGER, cell_y INTEGER
+) RETURNS GEOMETRY AS $$
+    SELECT
+        ST_Transform(
+            ST_MakeEnvelope(
+                cell_x * size - 20037508.342789244,
+                20037508.342789244 - (cell_y + 1) * size,
+                (cell_x + 1) * size - 20037508.342789244,
+                20037508.342789244 - cell_y * size,
+                3857
+            ),
+            4326
+        )
+    FROM
+        (SELECT 2 * 20037508.342789244 / ((2 ^ zoom) * poi_cluster_grid()) size) s
+$$ LANGUAGE sql IMMUTABLE;
+
+-- 点が含まれるすべてのズームレベルのセルと、点の座標(EPSG:3857)
+CREATE OR REPLACE FUNCTION poi_cluster_cells(geom GEOMETRY)
+RETURNS TABLE (
+    zoom INTEGER, cell_x INTEGER, cell_y INTEGER, x DOUBLE PRECISION, y DOUBLE PRECISION
+) AS $$
+    SELECT
+        z, cell.cell_x, cell.cell_y, ST_X(p), ST_Y(p)
+    FROM
+        generate_series(0, poi_cluster_max_zoom() - 1) z,
+        ST_Transform(geom, 3857) p,
+        LATERAL poi_cluster_cell(geom, z) cell
+$$ LANGUAGE sql IMMUTABLE;
+
+-- POIを含むセルのクラスタに加算
+CREATE OR REPLACE FUNCTION poi_cluster_add(
+    poi_id INTEGER, poi_name TEXT, poi_geom GEOMETRY
+) RETURNS VOID AS $$
+    INSERT INTO poi_cluster AS c (zoom, cell_x, cell_y, count, sum_x, sum_y, id, name)
+    SELECT
+        cells.zoom, cells.cell_x, cells.cell_y, 1, cells.x, cells.y, poi_id, poi_name
+    FROM
+        poi_cluster_cells(poi_geom) cells
+    ON CONFLICT (zoom, cell_x, cell_y) DO UPDATE SET
+        count = c.count + 1,
+        sum_x = c.sum_x + EXCLUDED.sum_x,
+        sum_y = c.sum_y + EXCLUDED.sum_y,
+        id = LEAST(c.id, EXCLUDED.id),
+        name = CASE WHEN EXCLUDED.id < c.id THEN EXCLUDED.name ELSE c.name END;
+$$ LANGUAGE sql;
+
+-- POIを含むセルのクラスタから減算
+-- 代表するPOIが削除されたクラスタのみ、セル内のPOIから代表を選び直す
+CREATE OR REPLACE FUNCTION poi_cluster_remove(
+    poi_id INTEGER, poi_geom GEOMETRY
+) RETURNS VOID AS $$
+    DELETE FROM poi_cluster c
+    USING poi_cluster_cells(poi_geom) cells
+    WHERE
+        c.zoom = cells.zoom
+        AND c.cell_x = cells.cell_x
+        AND c.cell_y = cells.cell_y
+        AND c.count <= 1;
+
+    UPDATE poi_cluster c SET
+        count = c.count - 1,
+        sum_x = c.sum_x - cells.x,
+        sum_y = c.sum_y - cells.y
+    FROM
+        poi_cluster_cells(poi_geom) cells
+    WHERE
+        c.zoom = cells.zoom
+        AND c.cell_x = cells.cell_x
+        AND c.cell_y = cells.cell_y;
+
+    UPDATE poi_cluster c SET
+        (id, name) = (
+            SELECT
+                poi.id, poi.name
+            FROM
+                poi,
+                LATERAL poi_cluster_cell(poi.geom, c.zoom) cell
+            WHERE
+                poi.geom && poi_cluster_cell_envelope(c.zoom, c.cell_x, c.cell_y)
+                AND cell.cell_x = c.cell_x
+                AND cell.cell_y = c.cell_y
+            ORDER BY
+                poi.id
+            LIMIT 1
+        )
+    FROM
+        poi_cluster_cells(poi_geom) cells
+    WHERE
+        c.zoom = cells.zoom
+        AND c.cell_x = cells.cell_x
+        AND c.cell_y = cells.cell_y
+        AND c.id = poi_id;
+$$ LANGUAGE sql;
+
+-- POIの登録、更新、削除時に、更新前と更新後の位置を含むセルのクラスタを差分で更新
+-- AFTERトリガーのため、代表を選び直す時点でpoiテーブルには変更が反映されている
+CREATE OR REPLACE FUNCTION poi_cluster_refresh() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        IF OLD.id = NEW.id AND OLD.geom IS NOT DISTINCT FROM NEW.geom THEN
+            -- 位置が変わらない場合は代表するPOIの名前のみを更新
+            IF OLD.name IS DISTINCT FROM NEW.name THEN
+                UPDATE poi_cluster SET name = NEW.name WHERE id = NEW.id;
+            END IF;
+            RETURN NULL;
+        END IF;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM poi_cluster_remove(OLD.id, OLD.geom);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM poi_cluster_add(NEW.id, NEW.name, NEW.geom);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS poi_cluster_refresh ON poi;
+CREATE TRIGGER poi_cluster_refresh
+AFTER INSERT OR UPDATE OR DELETE ON poi
+FOR EACH ROW EXECUTE FUNCTION poi_cluster_refresh();
+
+-- 既存のPOIからクラスタを作成
+INSERT INTO poi_cluster (zoom, cell_x, cell_y, count, sum_x, sum_y, id, name)
+SELECT
+    z,
+    cell.cell_x,
+    cell.cell_y,
+    count(*),
+    sum(ST_X(ST_Transform(poi.geom, 3857))),
+    sum(ST_Y(ST_Transform(poi.geom, 3857))),
+    min(poi.id),
+    (array_agg(poi.name ORDER BY poi.id))[1]
+FROM
+    generate_series(0, poi_cluster_max_zoom() - 1) z,
+    poi,
+    LATERAL poi_cluster_cell(poi.geom, z) cell
+GROUP BY
+    z, cell.cell_x, cell.cell_y;